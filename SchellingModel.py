@@ -1,6 +1,16 @@
-import random
+import threading
+
 import numpy as np
 
+from _schelling_kernel import apply_moves, make_kernel, pack_races
+
+# Streamlit 的每個 session 在各自的執行緒中執行腳本，而 _schelling_kernel 預設使用的 workqueue 平行後端
+# 不允許多個執行緒同時啟動平行核心 (會直接中止行程)，因此以這個全域鎖確保同一時間只有一個平行核心在執行。
+# 代價是所有 session 共用這個鎖：多位使用者同時執行模擬時，各自的 evaluate 會依序排隊，
+# 不過每次 evaluate 本身仍會用上所有 CPU 核心。
+_parallel_lock = threading.Lock()
+
+
 class Schelling:
     """
     謝林隔離模型 (Schelling Segregation Model)。
@@ -31,83 +41,53 @@ class Schelling:
         city_size = int(np.sqrt(self.size))**2
         
         # 根據給定的比例 p，隨機將 -1 (種族A), 1 (種族B), 0 (空屋) 分配到城市的一維陣列中
-        self.city = np.random.choice([-1, 1, 0], size=city_size, p=p)
+        # (數值只有 -1, 0, 1，以 int8 儲存即可，相較於預設的 int64 可減少 8 倍的記憶體頻寬)
+        self.city = np.random.choice([-1, 1, 0], size=city_size, p=p).astype(np.int8, copy=False)
         
         # 將一維陣列重塑為二維陣列 (網格)，代表城市的空間結構
         self.city = np.reshape(self.city, (int(np.sqrt(city_size)), int(np.sqrt(city_size))))
+
+        # 所有空房屋的座標 (E, 2)。空屋總數在模擬中不會改變，居民搬家時由 Numba 核心原地更新，
+        # 因此只需在初始化時掃描一次城市
+        self._empty = np.ascontiguousarray(np.argwhere(self.city == 0), dtype=np.int32)
+
+        # 兩個種族的位元棋盤 (每 64 間房屋一個 uint64 字組)，居民搬家時由 apply_moves 逐位元更新
+        n_words = (self.city.shape[1] + 63) // 64
+        self._race_a = np.zeros((self.city.shape[0], n_words), dtype=np.uint64)
+        self._race_b = np.zeros((self.city.shape[0], n_words), dtype=np.uint64)
+        pack_races(self.city, self._race_a, self._race_b)
+
+        # 每位居民目前是否不快樂，由 _evaluate() 計算，供下一次 run() 搬家使用；
+        # 同時保留這次計算的平均相似度比例 (self._mean_similarity)，呼叫端不必再走訪一次城市
+        self._unhappy = np.zeros(self.city.shape, dtype=np.bool_)
+        self._evaluate()
+
+    def _evaluate(self):
+        """
+        以平行化的 Numba 核心檢查目前城市中每位居民是否快樂 (更新 self._unhappy)，
+        並回傳平均相似度比例 (同時記錄在 self._mean_similarity)。
+        """
+        evaluate = make_kernel(self.n_neighbors)
+        with _parallel_lock:
+            self._mean_similarity = evaluate(self.city, self._race_a, self._race_b, self.similarity_threshold, self._unhappy)
+        return self._mean_similarity
     
     def run(self):
         """
         執行一次 Schelling 模型的模擬迭代。
         對於城市中的每個人，我們會根據 similarity_ratio (相似度比例) 和 similarity_threshold (相似度門檻) 
         來檢查他/她是否快樂。如果不快樂，就會將他/她搬到一個空房屋。
+        所有居民是否快樂都是依照迭代開始時的城市狀態一起決定，接著一次批次搬家 (同步更新)：
+        每位不快樂的居民搬到一間不同的、迭代開始時就是空屋的房屋；這與逐一檢查、逐一搬家的原始做法略有不同。
+        搬家後會立即重新檢查整個城市，回傳這次迭代後的平均相似度比例，並留下供下一次迭代使用的結果。
         """
-        # 遍歷城市網格中的每一個座標 (row, col) 以及對應的值 value (居民或空屋)
-        for (row, col), value in np.ndenumerate(self.city):
-            race = self.city[row, col]
-            
-            # 如果目前位置是有居民的 (race != 0)
-            if race != 0:
-                # 取得該居民周圍的社區 (neighborhood)，範圍由 n_neighbors 決定
-                neighborhood = self.city[row-self.n_neighbors:row+self.n_neighbors, col-self.n_neighbors:col+self.n_neighbors]
-                
-                # 計算社區的大小 (包含的總房屋數)
-                neighborhood_size = np.size(neighborhood)
-                
-                # 計算社區內的空房屋數量
-                n_empty_houses = len(np.where(neighborhood == 0)[0])
-                
-                # 確保社區內不只有該居民自己 (總房屋數不等於空屋數 + 居民自己1棟)
-                if neighborhood_size != n_empty_houses + 1:
-                    # 計算社區內相似（同種族）的鄰居數量 (減 1 是為了扣除居民自己)
-                    n_similar = len(np.where(neighborhood == race)[0]) - 1
-                    
-                    # 計算相似度比例 = 相似鄰居數 / (社區總大小 - 空屋數 - 1)
-                    similarity_ratio = n_similar / (neighborhood_size - n_empty_houses - 1.)
-                    
-                    # 判斷該居民是否因為相似度比例低於門檻而不快樂
-                    is_unhappy = (similarity_ratio < self.similarity_threshold)
-                    
-                    # 如果不快樂，則隨機選擇一個空房屋搬家
-                    if is_unhappy:
-                        # 找出目前城市中所有空房屋 (0) 的座標列表
-                        empty_houses = list(zip(np.where(self.city == 0)[0], np.where(self.city == 0)[1]))
-                        
-                        # 隨機挑選一個空房屋的座標
-                        random_house = random.choice(empty_houses)
-                        
-                        # 將該居民移至隨機挑選的空房屋
-                        self.city[random_house] = race
-                        
-                        # 將該居民原本的位置設為空房屋 (0)
-                        self.city[row,col] = 0
+        apply_moves(self.city, self._race_a, self._race_b, self._unhappy, self._empty)
+        return self._evaluate()
 
     def get_mean_similarity_ratio(self):
         """
         計算整個城市的平均相似度比例 (Average Similarity Ratio)。
         這能用來評估整個城市的隔離程度。
+        城市只會在 run() 中改變，而 run() 與初始化時都已重新計算過，因此這裡直接回傳記錄的結果。
         """
-        count = 0
-        similarity_ratio = 0
-        
-        # 遍歷城市網格中的每一個位置
-        for (row, col), value in np.ndenumerate(self.city):
-            race = self.city[row, col]
-            
-            # 針對有居民的房屋計算其各自的相似度比例
-            if race != 0:
-                # 取得該居民周圍的社區
-                neighborhood = self.city[row-self.n_neighbors:row+self.n_neighbors, col-self.n_neighbors:col+self.n_neighbors]
-                neighborhood_size = np.size(neighborhood)
-                n_empty_houses = len(np.where(neighborhood == 0)[0])
-                
-                if neighborhood_size != n_empty_houses + 1:
-                    n_similar = len(np.where(neighborhood == race)[0]) - 1
-                    
-                    # 累加每位居民的相似度比例
-                    similarity_ratio += n_similar / (neighborhood_size - n_empty_houses - 1.)
-                    count += 1
-                    
-        # 回傳總相似度比例除以計算的人數，即為整個城市的平均相似度比例
-        return similarity_ratio / count
-        
\ No newline at end of file
+        return self._mean_similarity
@@ -0,0 +1,204 @@
+"""
+Schelling 模型的 Numba 核心運算 (Numba kernels for the Schelling model)。
+這裡只放純數值的迴圈，城市網格與空屋座標等陣列都由 SchellingModel.Schelling 事先準備好再傳入。
+城市網格固定為 C 連續的 int8 陣列 (int8[:, ::1])，以明確的型別簽名編譯；int8 讓讀取居民種族與搬家時的寫入只佔用最少的記憶體頻寬。
+
+計算鄰居時使用位元棋盤 (bitboard)：每個種族各一個 uint64[n, n_words] 陣列，第 r 列第 w 個字組的第 j 個位元
+代表 city[r, 64 * w + j] 是否為該種族。一列社區內的同種族數量只需一次 AND 加上一次 popcount 即可求得。
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+from numba import config, njit, prange, boolean, float64, int8, int32, uint64, void
+from numba.extending import intrinsic
+
+# 未另外設定 NUMBA_THREADING_LAYER 時，改用 workqueue 平行後端。Numba 預設會依序嘗試 tbb、omp、workqueue，
+# 但在 tbb 下，只要從非主執行緒 (例如 Streamlit 的工作執行緒) 執行過 parallel=True 的核心，
+# 直譯器結束時就會卡住。workqueue 不允許多個執行緒同時啟動平行核心，由 SchellingModel 以鎖序列化呼叫。
+# 注意這是整個行程共用的 Numba 設定；部署時若已設定環境變數，則以該設定為準。
+if 'NUMBA_THREADING_LAYER' not in os.environ:
+    config.THREADING_LAYER = 'workqueue'
+
+_ALL_BITS = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+@intrinsic
+def _popcount(typingctx, x):
+    """
+    計算 uint64 中為 1 的位元數 (編譯為 LLVM 的 ctpop，在支援的 CPU 上即為單一 POPCNT 指令)。
+    """
+    sig = uint64(uint64)
+
+    def codegen(context, builder, signature, args):
+        return builder.ctpop(args[0])
+
+    return sig, codegen
+
+
+@njit(inline='always')
+def _bit_range(lo, hi):
+    """
+    回傳第 lo 到第 hi - 1 個位元為 1 的 uint64 遮罩 (0 <= lo < hi <= 64)。
+    """
+    upper = _ALL_BITS if hi == 64 else (np.uint64(1) << np.uint64(hi)) - np.uint64(1)
+    lower = (np.uint64(1) << np.uint64(lo)) - np.uint64(1)
+    return upper & ~lower
+
+
+@njit(void(int8[:, ::1], uint64[:, ::1], uint64[:, ::1]), cache=True)
+def pack_races(city, race_a, race_b):
+    """
+    依照 city 重新建立兩個種族的位元棋盤 (race_a 對應 -1，race_b 對應 1)。
+    """
+    n = city.shape[0]
+    race_a[:] = 0
+    race_b[:] = 0
+    for row in range(n):
+        for col in range(n):
+            bit = np.uint64(1) << np.uint64(col & 63)
+            if city[row, col] == -1:
+                race_a[row, col >> 6] |= bit
+            elif city[row, col] == 1:
+                race_b[row, col >> 6] |= bit
+
+
+@njit(inline='always')
+def _count_neighbors(race_a, race_b, row, col, k):
+    """
+    計算 (row, col) 周圍社區內的種族總和與有居民的房屋數量 (皆包含居民自己)。
+    社區範圍為以 (row, col) 為中心、上下左右各 k 格的 (2k+1) x (2k+1) 方形，即 city[row-k:row+k+1, col-k:col+k+1]，
+    超出城市邊界的部分不列入計算 (視為空屋)。
+    每一列只需對社區涵蓋的字組 (2k+1 <= 64 時最多兩個) 做 AND 與 popcount，不需要逐格讀取。
+    此函式會被內嵌到 make_kernel 產生的核心中，k 在那裡是編譯期常數：
+    社區完全不超出上下邊界時，列的迴圈次數固定為 2k+1，編譯器可以完全展開。
+    """
+    n = race_a.shape[0]
+    c0 = max(0, col - k)
+    c1 = min(n, col + k + 1)
+    n_a = np.uint64(0)
+    n_b = np.uint64(0)
+    for w in range(c0 >> 6, ((c1 - 1) >> 6) + 1):
+        # 此字組中落在社區範圍內的位元
+        mask = _bit_range(max(c0, w << 6) - (w << 6), min(c1, (w + 1) << 6) - (w << 6))
+        if k <= row and row + k < n:
+            # 社區完全位於上下邊界內：迴圈次數固定為 2k+1
+            for r in range(row - k, row + k + 1):
+                n_a += _popcount(race_a[r, w] & mask)
+                n_b += _popcount(race_b[r, w] & mask)
+        else:
+            # 靠近上下邊界的位置：只計算城市內的列
+            for r in range(max(0, row - k), min(n, row + k + 1)):
+                n_a += _popcount(race_a[r, w] & mask)
+                n_b += _popcount(race_b[r, w] & mask)
+    return np.int64(n_b) - np.int64(n_a), np.int64(n_a + n_b)
+
+
+@njit(inline='always')
+def _flip(race_a, race_b, race, row, col):
+    """
+    在對應種族的位元棋盤上翻轉 (row, col) 的位元。
+    """
+    bit = np.uint64(1) << np.uint64(col & 63)
+    if race == -1:
+        race_a[row, col >> 6] ^= bit
+    else:
+        race_b[row, col >> 6] ^= bit
+
+
+@njit(void(int8[:, ::1], uint64[:, ::1], uint64[:, ::1], boolean[:, ::1], int32[:, ::1]), cache=True)
+def apply_moves(city, race_a, race_b, unhappy, empty_idx_buf):
+    """
+    將 unhappy 標記為不快樂的居民一次批次搬到隨機的空房屋 (原地修改 city、位元棋盤與 empty_idx_buf)。
+    empty_idx_buf 為所有空房屋座標的 (E, 2) 陣列。先將不快樂的居民與空屋各自隨機洗牌，
+    再把前 m = min(居民數, 空屋數) 組一對一配對搬家，每位居民都搬到不同的空屋；
+    同一次迭代中空出來的房屋不會再被其他人選中 (同步更新)，空屋不足時只有隨機挑出的 m 位居民搬家。
+    居民搬走後，原本的位置直接寫回被使用的空屋欄位，因此不需要重新掃描整個城市。
+    """
+    n = city.shape[0]
+    n_empty = empty_idx_buf.shape[0]
+
+    # 收集所有不快樂居民的座標
+    n_unhappy = 0
+    for row in range(n):
+        for col in range(n):
+            if unhappy[row, col]:
+                n_unhappy += 1
+    movers = np.empty((n_unhappy, 2), dtype=np.int32)
+    i = 0
+    for row in range(n):
+        for col in range(n):
+            if unhappy[row, col]:
+                movers[i, 0] = row
+                movers[i, 1] = col
+                i += 1
+
+    # 只需洗牌前 m 個位置 (部分 Fisher-Yates)：隨機挑出要搬家的居民，以及他們各自的空屋
+    m = min(n_unhappy, n_empty)
+    for i in range(m):
+        j = np.random.randint(i, n_unhappy)
+        movers[i, 0], movers[j, 0] = movers[j, 0], movers[i, 0]
+        movers[i, 1], movers[j, 1] = movers[j, 1], movers[i, 1]
+        j = np.random.randint(i, n_empty)
+        empty_idx_buf[i, 0], empty_idx_buf[j, 0] = empty_idx_buf[j, 0], empty_idx_buf[i, 0]
+        empty_idx_buf[i, 1], empty_idx_buf[j, 1] = empty_idx_buf[j, 1], empty_idx_buf[i, 1]
+
+    for i in range(m):
+        row = movers[i, 0]
+        col = movers[i, 1]
+        new_row = empty_idx_buf[i, 0]
+        new_col = empty_idx_buf[i, 1]
+        race = city[row, col]
+        city[new_row, new_col] = race
+        city[row, col] = 0
+        _flip(race_a, race_b, race, row, col)
+        _flip(race_a, race_b, race, new_row, new_col)
+        empty_idx_buf[i, 0] = row
+        empty_idx_buf[i, 1] = col
+
+
+@lru_cache(maxsize=None)
+def make_kernel(k):
+    """
+    產生針對固定鄰居數 k 特化的 evaluate 核心。
+    k 在模擬過程中不會改變，將其當作常數編譯可讓城市內部社區的列迴圈次數 (2k+1) 在編譯期即確定；
+    每個 k 只會編譯一次 (cache=True 亦會將編譯結果存到磁碟)。
+    """
+
+    @njit(float64(int8[:, ::1], uint64[:, ::1], uint64[:, ::1], float64, boolean[:, ::1]),
+          parallel=True, cache=True, fastmath=True)
+    def evaluate(city, race_a, race_b, threshold, unhappy):
+        """
+        檢查城市中每一位居民是否快樂，將結果寫入 unhappy，並回傳整個城市的平均相似度比例
+        (沒有任何居民擁有鄰居時回傳 NaN)。
+        這一步只讀取 city 與兩個位元棋盤 (race_a、race_b)，每一列之間互不相依，因此以 prange 將各列分配到多個執行緒平行計算。
+        """
+        n = city.shape[0]
+        similarity_sum = 0.0
+        count = 0
+        for row in prange(n):
+            for col in range(n):
+                unhappy[row, col] = False
+                race = city[row, col]
+                if race == 0:
+                    continue
+
+                race_sum, n_occupied = _count_neighbors(race_a, race_b, row, col, k)
+
+                # 扣除居民自己之後的鄰居數與相似鄰居數
+                n_occupied_neighbors = n_occupied - 1
+                if n_occupied_neighbors == 0:
+                    continue
+                n_similar = (n_occupied + race * race_sum) // 2 - 1
+                similarity_ratio = n_similar / n_occupied_neighbors
+
+                similarity_sum += similarity_ratio
+                count += 1
+                unhappy[row, col] = similarity_ratio < threshold
+
+        # 沒有任何居民擁有鄰居時 (例如空屋比例接近 1)，平均相似度比例沒有定義
+        if count == 0:
+            return np.nan
+        return similarity_sum / count
+
+    return evaluate
@@ -1,9 +1,23 @@
 import streamlit as st
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 
 from SchellingModel import Schelling
 
+# 城市網格的顏色：-1 為種族A (紅)、0 為空屋 (白)、1 為種族B (藍)
+CITY_COLORSCALE = [[0, 'red'], [0.5, 'white'], [1, 'royalblue']]
+
+
+@st.cache_data
+def make_model(size, empty_ratio, similarity_threshold, n_neighbors):
+    """
+    建立 Schelling 模型並依參數快取，回傳 (模型, 初始的平均相似度比例)。
+    Streamlit 每次調整側邊欄都會重新執行整個腳本，快取可避免參數未變時重新隨機產生城市及重新計算初始相似度比例。
+    (使用 cache_data 而非 cache_resource：每次取得的都是副本，模擬時修改城市不會影響快取中的初始狀態)
+    """
+    schelling = Schelling(size, empty_ratio, similarity_threshold, n_neighbors)
+    return schelling, schelling.get_mean_similarity_ratio()
+
 
 def main():
 
@@ -17,56 +31,46 @@ def main():
     n_iterations = st.sidebar.number_input("Number of Iterations", 50)
 
     # 初始化 Schelling 模型
-    schelling = Schelling(population_size, empty_ratio, similarity_threshold, 3)
-    mean_similarity_ratio = []
-    mean_similarity_ratio.append(schelling.get_mean_similarity_ratio())
+    schelling, initial_similarity_ratio = make_model(population_size, empty_ratio, similarity_threshold, 3)
+    mean_similarity_ratio = [initial_similarity_ratio]
 
-    plt.style.use("ggplot")
-    plt.rcParams['axes.unicode_minus'] = False
-    
-    fig = plt.figure(figsize=(14, 6))
+    # 只建立一次 Plotly 圖表，模擬過程中只更新其中的資料；
+    # 每次更新只需傳送城市網格與相似度比例的數值，由瀏覽器端繪製，不必在伺服器端產生整張圖片
+    fig = make_subplots(rows=1, cols=2, subplot_titles=("", "Mean Similarity Ratio"))
     
     # 左側圖表：城市空間的網格狀態
-    cmap = ListedColormap(['red', 'white', 'royalblue'])
-    ax1 = fig.add_subplot(121)
-    ax1.axis('off')
-    ax1.pcolor(schelling.city, cmap=cmap, edgecolors='w', linewidths=1)
+    fig.add_trace(go.Heatmap(z=schelling.city, zmin=-1, zmax=1, colorscale=CITY_COLORSCALE,
+                             showscale=False, xgap=1, ygap=1, hoverinfo='skip'), row=1, col=1)
+    fig.update_xaxes(visible=False, constrain='domain', row=1, col=1)
+    fig.update_yaxes(visible=False, scaleanchor='x', constrain='domain', row=1, col=1)
     
     # 右側圖表：平均相似度比例的變化圖
-    ax2 = fig.add_subplot(122)
-    ax2.set_xlabel("Iterations")
-    ax2.set_xlim([0, n_iterations])
-    ax2.set_ylim([0.4, 1])
-    ax2.set_title("Mean Similarity Ratio", fontsize=15)
-    ax2.text(1, 0.95, "Similarity Ratio: %.4f" % schelling.get_mean_similarity_ratio(), fontsize=10)
+    fig.add_trace(go.Scatter(x=[], y=[], mode='lines', showlegend=False), row=1, col=2)
+    fig.update_xaxes(title_text="Iterations", range=[0, n_iterations], row=1, col=2)
+    fig.update_yaxes(range=[0.4, 1], row=1, col=2)
+    fig.add_annotation(x=1, y=0.95, xref='x2', yref='y2', xanchor='left', showarrow=False,
+                       text="Similarity Ratio: %.4f" % mean_similarity_ratio[-1])
+    fig.update_layout(template='ggplot2', plot_bgcolor='white', height=600, margin=dict(t=60, b=40))
 
-    city_plot = st.pyplot(fig, width="stretch")
+    city_plot = st.empty()
+    city_plot.plotly_chart(fig, width="stretch", theme=None)
 
     progress_bar = st.progress(0)
 
     if st.sidebar.button('Run Simulation'):
         for i in range(int(n_iterations)):
-            schelling.run()
-            mean_similarity_ratio.append(schelling.get_mean_similarity_ratio())
-            
-            fig = plt.figure(figsize=(14, 6))
+            # run() 會一併回傳這次迭代的平均相似度比例
+            mean_similarity_ratio.append(schelling.run())
             
             # 更新左側城市空間圖
-            ax1 = fig.add_subplot(121)
-            ax1.axis('off')
-            ax1.pcolor(schelling.city, cmap=cmap, edgecolors='w', linewidths=1)
+            fig.data[0].z = schelling.city
             
             # 更新右側平均相似度比例圖
-            ax2 = fig.add_subplot(122)
-            ax2.set_xlabel("Iterations")
-            ax2.set_xlim([0, n_iterations])
-            ax2.set_ylim([0.4, 1])
-            ax2.set_title("Mean Similarity Ratio", fontsize=15)
-            ax2.plot(range(1, len(mean_similarity_ratio)+1), mean_similarity_ratio)
-            ax2.text(1, 0.95, "Similarity Ratio: %.4f" % schelling.get_mean_similarity_ratio(), fontsize=10)
+            fig.data[1].x = list(range(1, len(mean_similarity_ratio)+1))
+            fig.data[1].y = mean_similarity_ratio
+            fig.layout.annotations[-1].text = "Similarity Ratio: %.4f" % mean_similarity_ratio[-1]
             
-            city_plot.pyplot(fig, width="stretch")
-            plt.close(fig)
+            city_plot.plotly_chart(fig, width="stretch", theme=None)
             
             progress_bar.progress((i + 1.) / int(n_iterations))
 